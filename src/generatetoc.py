@@ -6,5 +6,5 @@ if __name__ == "__main__":
 
     chdir( sys.argv[1] )
 
-    # print(githubwikitoc.scan_files())
+    # githubwikitoc.scan_files(sys.stdout.write)
     githubwikitoc.generate_toc()
@@ -1,21 +1,35 @@
-from os import rename, scandir
+from os import rename, scandir, close, O_RDONLY
+from os import open as os_open, read as os_read
 from os.path import splitext
-import re
-import fileinput
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
 
 
 """
 Generates table of contents for a wiki
 """
 
-# excludes files and folders that start with a dot, like .git or .DS_Store
-# also excludes _Sidebar.md, _Footer.md, and Home.md
-file_exclusion_re: re.Pattern = re.compile(
-    r"^\..*$|^_Sidebar\.md$|^_Footer.md$|Home.md"
-)
+# files that are never listed in the ToC. Files and folders that start with
+# a dot, like .git or .DS_Store, are also excluded. Home.md.old is the
+# previous Home.md that generate_toc() moves out of the way, which may be
+# left over from an earlier run.
+excluded_files: FrozenSet[str] = frozenset({
+    "_Sidebar.md",
+    "_Footer.md",
+    "Home.md",
+    "Home.md.old",
+})
+# lines that mark the start and end of the ToC in Home.md
+toc_start_marker = "<!--start TOC-->\n"
+toc_end_marker = "<!--end TOC-->\n"
 dash_to_space = str.maketrans("-", " ")
 underscore_to_space = str.maketrans("_", " ")
+# Markdown heading prefixes, indexed by heading level
+heading_prefixes = tuple("#" * level for level in range(16))
+# number of bytes read at a time from the top of each file when looking for tags
+first_block_size = 512
+# number of threads used to read the files
+scan_workers = 32
 
 
 def generate_toc() -> None:
@@ -27,99 +41,201 @@ def generate_toc() -> None:
     start and text below the end will be preserved.
     """
 
+    # list the pages before Home.md is moved out of the way
+    files_to_scan = _list_wiki_files()
     rename( "Home.md", "Home.md.old" )
+    with open( "Home.md.old", "r" ) as old_home_md:
+        old_text = old_home_md.read()
+
     with open( "Home.md", "w" ) as new_home_md:
-        with open( "Home.md.old", "r" ) as old_home_md:
-
-            # Read and dump out text before the ToC
-            while one_line := old_home_md.readline():
-                if one_line == "<!--start TOC-->\n":
-                    # We reached the top of the old TOC
-                    break
-                else:
-                    # We haven't reached the top of the old TOC yet so
-                    # transfer the old content to the new file.
-                    new_home_md.write(one_line)
-
-            if len(one_line) == 0:
-                # reached EOF without finding an existing TOC
-                # Put the TOC at the beginning of the file, then
-                # rewind and put the rest of the old home file's content
-                # after that.
-                # This is slightly inefficient, but good enough for this purpose
-                new_home_md.seek(0)
-                new_home_md.write(scan_files())
-                old_home_md.seek(0)
-                for existing_line in old_home_md:
-                    new_home_md.write(existing_line)
-                return
-
-            # We found the old TOC, so skip lines until the end of the old TOC
-            while one_line := old_home_md.readline():
-                if one_line == "<!--end TOC-->\n":
-                    break
-
-            # Either we found the old TOC and skipped to the bottom of it
-            # or we never found the bottom marker and skipped all of the rest
-            # of the file.
-            # In either case write the new TOC
-            new_home_md.write( scan_files() )
-
-            # Read and dump out text after the ToC
-            while one_line := old_home_md.readline():
-                new_home_md.write(one_line)
-
-
-def scan_files() -> str:
+        toc_start = _find_line( old_text, toc_start_marker )
+        if toc_start == -1:
+            # no existing TOC, so put the TOC at the beginning of the file
+            # followed by all of the old home file's content
+            scan_files( new_home_md.write, files_to_scan )
+            new_home_md.write( old_text )
+            return
+
+        # dump out text before the ToC, then the new ToC
+        new_home_md.write( old_text[:toc_start] )
+        scan_files( new_home_md.write, files_to_scan )
+
+        # Dump out text after the end of the old ToC. If the end marker is
+        # missing then the rest of the file is treated as part of the old ToC.
+        toc_end = _find_line( old_text, toc_end_marker, toc_start )
+        if toc_end != -1:
+            new_home_md.write( old_text[toc_end + len(toc_end_marker):] )
+
+
+def _find_line( text: str, line: str, start: int = 0 ) -> int:
+    """
+    Find a complete line within some text.
+
+    :param text: text to be searched
+    :param line: line to look for, including the trailing newline
+    :param start: index in text to start searching from
+    :return: index of the start of the line, or -1 if it was not found
+    """
+    while (found := text.find( line, start )) != -1:
+        if found == 0 or text[found - 1] == "\n":
+            return found
+        start = found + 1
+
+    return -1
+
+
+def scan_files(
+        write: Callable[[str], Any],
+        files_to_scan: Optional[List[str]] = None
+) -> None:
     """
     Scan the wiki files and produce a Table of Contents.
     The ToC uses MediaWiki-style links because GitHub Wikis are bugged.
 
-    :return: Markdown-formatted (with MediaWiki-style links) ToC
+    :param write: called with each piece of the Markdown-formatted (with
+        MediaWiki-style links) ToC, in order
+    :param files_to_scan: sorted list of pages from _list_wiki_files(). If
+        omitted, the current directory is listed.
     """
-    result: str = "<!--start TOC-->\n\n# Table of Contents\n\n"
     tag_tree: dict = {
-        "untagged": set()
+        "files": [],
+        "sub_tags": {}
+    }
+
+    if files_to_scan is None:
+        files_to_scan = _list_wiki_files()
+
+    # Build the link for each page once here because a file that has several
+    # tags is rendered several times.
+    page_links: Dict[str, str] = {
+        fn: _make_page_link(fn)
+        for fn in files_to_scan
     }
 
-    # get the list of files
-    files_in_dir = scandir()
-    files_to_scan = [
-        f.name
-        for f in files_in_dir
-        if f.is_file() and not file_exclusion_re.match(f.name)
-    ]
-
-    with fileinput.input(files_to_scan,
-                         openhook=lambda filename, mode: open(filename, mode, errors="replace" )) as f:
-        for one_line in f:
-            fn = fileinput.filename()
-            # assume the file is untagged
-            tag_tree["untagged"].add(fn)
-            if len(tags_list := _scan_line_for_tags( one_line )) > 0:
-                # tag found, remove the file from the list of completely untagged files
-                # and add it to one of the tag entries
-                tag_tree["untagged"].discard(fn)
-                for one_tag in tags_list:
+    # Reading the files is I/O bound, so overlap the reads in a thread pool.
+    # The tag tree is only touched from this thread.
+    with ThreadPoolExecutor( max_workers=scan_workers ) as executor:
+        for fn, tags_list in zip( files_to_scan,
+                                  executor.map( _scan_file_for_tags, files_to_scan ) ):
+            if len(tags_list) > 0:
+                # tag found, add the file to each of the tag entries. A tag
+                # that is repeated on the line is only added once.
+                for one_tag in dict.fromkeys(tags_list):
                     _add_filename_to_tag_dict( fn, one_tag, tag_tree )
-                fileinput.nextfile()
+            else:
+                # no tags, so the file goes in the completely untagged list
+                tag_tree["files"].append(fn)
+
+    _sort_tag_tree(tag_tree)
+    write(toc_start_marker)
+    write("\n# Table of Contents\n\n")
+    _render_tag_tree(tag_tree, write, page_links)
+    write(toc_end_marker)
+
+
+def _list_wiki_files() -> List[str]:
+    """
+    List the wiki pages in the current directory that belong in the ToC.
+
+    :return: sorted list of filenames
+    """
+    with scandir() as files_in_dir:
+        files_to_scan = [
+            f.name
+            for f in files_in_dir
+            if f.is_file(follow_symlinks=False) and _is_wiki_page(f.name)
+        ]
+    # Sort once here. Files are added to the tag tree in this order, so
+    # every list of files in the tree ends up sorted too.
+    files_to_scan.sort()
 
-    result += _render_tag_tree(tag_tree) + "<!--end TOC-->\n"
+    return files_to_scan
 
-    return result
 
+def _is_wiki_page( filename: str ) -> bool:
+    """
+    Check whether a file should be listed in the ToC.
+
+    :param filename: name of the file
+    :return: True if the file is a wiki page that belongs in the ToC
+    """
+    return filename[0] != "." and filename not in excluded_files
+
+
+def _make_page_link( filename: str ) -> str:
+    """
+    Make the Markdown link line for a page.
 
-def _scan_line_for_tags( line_to_scan: str ) -> List[str]:
+    :param filename: name of the page's file
+    :return: link to the page, followed by a blank line
     """
-    Scan a single file for tags. This is a line that looks like:
+    # strip off the extension then change dashes to spaces
+    # Prefix link with 'wiki/' so that it works right
+    # This is a GitHub bug
+    stripped_filename = splitext(filename)[0]
+    munged_filename = stripped_filename.translate(dash_to_space)
+    return f"[{munged_filename}](wiki/{stripped_filename})\n\n"
+
+
+def _scan_file_for_tags( filename: str ) -> List[str]:
+    """
+    Scan the top of a single file for tags. Tags go at the top of the page,
+    so only the first non-blank line is checked. Raw reads of the file avoid
+    the overhead of buffered text IO.
+
+    :param filename: path to a file to be scanned
+    :return: list of tags in that file
+    """
+    fd = os_open( filename, O_RDONLY )
+    try:
+        first_line = _read_first_line( fd )
+    finally:
+        close( fd )
+
+    return _scan_line_for_tags( first_line )
+
+
+def _read_first_line( fd: int ) -> bytes:
+    """
+    Read the first non-blank line of a file. The file is read a block at a
+    time, and usually the first block is all that is needed. More blocks are
+    read only when the line hasn't ended by the end of the block.
+
+    :param fd: file descriptor of the file, positioned at its start
+    :return: first non-blank line without its newline, or b"" if the file
+        has no non-blank lines
+    """
+    buffer = b""
+    while True:
+        block = os_read( fd, first_block_size )
+        buffer += block
+        # drop the complete blank lines at the top
+        while (line_end := buffer.find( b"\n" )) != -1 and not buffer[:line_end].strip():
+            buffer = buffer[line_end + 1:]
+
+        if line_end != -1:
+            return buffer[:line_end]
+        if len(block) < first_block_size:
+            # reached EOF, so whatever is left is the last line of the file
+            return buffer if buffer.strip() else b""
+
+
+def _scan_line_for_tags( line_to_scan: bytes ) -> List[str]:
+    """
+    Scan a single line for tags. This is a line that looks like:
     Tags: Tag_One Tag_Two Tag_Three-Sub_Tag_A
+    The check is done on the raw bytes so that lines without tags are
+    never decoded.
 
-    :param line_to_scan: path to a file to be scanned
+    :param line_to_scan: line to be scanned
     :return: list of tags in that line
     """
-    if line_to_scan.startswith( "Tags: " ):
+    if line_to_scan.startswith( b"Tags: " ):
         # return a list of tags, without the initial Tags: indicator
-        return line_to_scan.split()[1:]
+        return [
+            one_tag.decode( errors="replace" )
+            for one_tag in line_to_scan[6:].split()
+        ]
 
     else:
         return []
@@ -127,20 +243,29 @@ def _scan_line_for_tags( line_to_scan: str ) -> List[str]:
 
 def _add_filename_to_tag_dict( filename: str, tag_seq: str, tag_dict: dict ) -> None:
     """
-    Add the filename to the tag dict. The dict structure looks like:
+    Add the filename to the tag dict. Each level of the dict has the files
+    tagged at exactly that level and the tags nested below it. The top level
+    has the completely untagged files. The dict structure looks like:
     {
-        "untagged": {"file1", "file2", "file3"}
-        "tag1": {
-            "untagged": ["file4"]
-        }
-        "tag2": {
-            "untagged": {}
-            "sub-tag3": {
-                "untagged": {"file5", "file6"}
+        "files": ["file1", "file2", "file3"]
+        "sub_tags": {
+            "tag1": {
+                "files": ["file4"]
+                "sub_tags": {}
+            }
+            "tag2": {
+                "files": []
+                "sub_tags": {
+                    "sub-tag3": {
+                        "files": ["file5", "file6"]
+                        "sub_tags": {}
+                    }
+                }
+            }
+            "tag4": {
+                "files": ["file5"]
+                "sub_tags": {}
             }
-        }
-        "tag4": {
-            "untagged": {"file5"}
         }
     }
 
@@ -150,32 +275,61 @@ def _add_filename_to_tag_dict( filename: str, tag_seq: str, tag_dict: dict ) ->
     """
     current_dict = tag_dict
     for current_level in tag_seq.split("-"):
-        current_dict = current_dict.setdefault( current_level, dict() )
-    current_dict.setdefault( "untagged", set() ).add(filename)
+        current_dict = current_dict["sub_tags"].setdefault(
+            current_level, {"files": [], "sub_tags": {}}
+        )
+    current_dict["files"].append(filename)
 
 
-def _render_tag_tree( tag_tree: dict, level: int = 2 ) -> str:
+def _sort_tag_tree( tag_dict: dict ) -> None:
     """
-    Render the tag tree into a string with links to the pages.
+    Reorder the sub-tags of every level of the tag dict alphabetically, so
+    that the tree can be rendered without sorting. The file lists are
+    already in order because the files were scanned in order.
+
+    :param tag_dict: dictionary containing the tags
+    """
+    tag_dict["sub_tags"] = dict(sorted(tag_dict["sub_tags"].items()))
+    for sub_dict in tag_dict["sub_tags"].values():
+        _sort_tag_tree(sub_dict)
+
+
+def _render_tag_tree(
+        tag_tree: dict,
+        write: Callable[[str], Any],
+        page_links: Dict[str, str],
+        level: int = 2
+) -> None:
+    """
+    Render the tag tree into Markdown with links to the pages.
+    The tree must already have been sorted by _sort_tag_tree().
 
     :param tag_tree: dict containing the tags
+    :param write: called with each rendered Markdown fragment
+    :param page_links: maps each filename to its rendered link
     :param level: how many #'s to put in front of tag headings
-    :return: tag tree rendered as Markdown
     """
-    result = ""
-
-    for one_filename in sorted(list(tag_tree["untagged"])):
-        # strip off the extension then change dashes to spaces
-        # Prefix link with 'wiki/' so that it works right
-        # This is a GitHub bug
-        stripped_filename = splitext(one_filename)[0]
-        munged_filename = stripped_filename.translate(dash_to_space)
-        result += f"[{munged_filename}](wiki/{stripped_filename})\n\n"
+    # Walk the tree depth-first with an explicit stack instead of recursing.
+    # Each entry is a tag heading (or None for the top of the tree), the
+    # node under that heading, and the level of that node's sub-tag headings.
+    stack: List[Tuple[Optional[str], dict, int]] = [(None, tag_tree, level)]
+    while stack:
+        heading, node, node_level = stack.pop()
+        if heading is not None:
+            write(heading)
 
-    sub_tags = sorted(tag_tree.keys())
-    sub_tags.remove("untagged")
-    for one_tag in sub_tags:
-        result += f"{'#'*level} {one_tag.translate(underscore_to_space)}\n\n"
-        result += _render_tag_tree( tag_tree[one_tag], level+1 )
+        # write all of the node's links at once
+        if node["files"]:
+            write("".join([page_links[one_filename] for one_filename in node["files"]]))
 
-    return result
+        if node_level < len(heading_prefixes):
+            heading_prefix = heading_prefixes[node_level]
+        else:
+            heading_prefix = "#" * node_level
+        # push in reverse so that the sub-tags come off the stack in order
+        for one_tag, sub_tree in reversed(node["sub_tags"].items()):
+            stack.append((
+                f"{heading_prefix} {one_tag.translate(underscore_to_space)}\n\n",
+                sub_tree,
+                node_level + 1
+            ))